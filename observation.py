@@ -15,7 +15,7 @@ class Observations:
     a certain resource or not.
     """
 
-    def __init__(self):
+    def __init__(self, timeslots: int):
         """
         Initialize to an empty set of observations.
         Right now, this is a mix of numpy and python as I think we need constructs from both.
@@ -27,18 +27,20 @@ class Observations:
         allocation_time - the total time allocation
         obs_time - the length of the observation
         allocated - the time allocated for the observation
-        valid_site_times - a list of map {timeslot_t -> Set(Site)} representing what sites the observation can be
-                            observed at at
-                            time t
+        site_mask - an array indexed by [observation, timeslot] representing what sites the observation can be
+                    observed at at time t, where each set of sites is represented as a bitmask of the site values
         priority - the priority for time slice t
+
+        :param timeslots: the number of timeslots over which the observations are scheduled
         """
+        self.timeslots = timeslots
         self.num_obs = 0
         self.band = np.empty((0,), dtype=str)
         self.completed = np.empty((0,), dtype=float)
         self.used_time = np.empty((0,), dtype=float)
         self.allocated_time = np.empty((0,), dtype=float)
         self.obs_time = np.empty((0,), dtype=float)
-        self.valid_site_times = []
+        self.site_mask = np.empty((0, timeslots), dtype=np.uint8)
         self.priority = np.empty((0,), dtype=float)
 
         self.params = {'1': {'m1': 1.406, 'b1': 2.0, 'm2': 0.50, 'b2': 0.5, 'xb': 0.8, 'xb0': 0.0, 'xc0': 0.0},
@@ -66,7 +68,14 @@ class Observations:
                 obs_time: float):
         assert (allocated_time != 0)
         self.band = np.append(self.band, band)
-        self.valid_site_times.append(valid_times)
+
+        # Timeslots outside the scheduling period can never be scheduled, so they need not be recorded.
+        site_mask = np.zeros((1, self.timeslots), dtype=np.uint8)
+        for timeslot, sites in valid_times.items():
+            if 0 <= timeslot < self.timeslots:
+                site_mask[0, timeslot] = resources.sites_mask(sites)
+        self.site_mask = np.append(self.site_mask, site_mask, axis=0)
+
         self.used_time = np.append(self.used_time, 0)
         self.allocated_time = np.append(self.allocated_time, allocated_time)
         self.obs_time = np.append(self.obs_time, obs_time)
@@ -78,7 +87,7 @@ class Observations:
                  self.band[id],
                  self.completed[id],
                  self.priority[id],
-                 resources.timeslot_sites_string(self.valid_site_times[id], timeslot)))
+                 resources.timeslot_sites_string(self.site_mask[id], timeslot)))
 
     def tick(self, timeslot: int):
         self.calculate_priority()
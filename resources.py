@@ -3,20 +3,29 @@
 
 # The resources available for scheduling, in groups that do not clash.
 from enum import Enum
-from typing import Mapping, Set
+from typing import Sequence, Set
 
 
+# The values of the sites are distinct bits, so that a set of sites can be represented as a bitmask.
 class Site(Enum):
     GN = 1
     GS = 2
 
 
-def timeslot_sites_string(sites: Mapping[int, Set[Site]], timeslot: int) -> str:
-    return sites_string(sites[timeslot])
+def sites_mask(sites: Set[Site]) -> int:
+    mask = 0
+    for site in sites:
+        mask |= site.value
+    return mask
 
 
-def sites_string(sites: Set[Site]) -> str:
-    return ' '.join([site.name for site in sites])
+# The string representation of each of the possible site bitmasks.
+_MASK_STRINGS = [' '.join([site.name for site in Site if mask & site.value]) for mask in range(4)]
+
+
+def timeslot_sites_string(site_masks: Sequence[int], timeslot: int) -> str:
+    return _MASK_STRINGS[site_masks[timeslot]]
+
 
 # If an observation O can be run on both sites n = GN and s = GS, we need the constraint:
 # O_int + O_ist <= 0
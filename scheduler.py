@@ -2,10 +2,34 @@
 
 from observation import Observations
 import resources
+from resources import Site
 
-from typing import List, Tuple
+import atexit
+import os
+import sys
+from typing import Dict, List, Optional, Tuple
+import numpy as np
 from gurobipy import *
 
+# Bind the sites once, rather than looking them up on the Site enum on every use.
+GN = Site.GN
+GS = Site.GS
+_SITE_BY_NAME = {"GN": GN, "GS": GS}
+
+# The Gurobi environment shared by all the models, so that the license is only checked out once per process.
+# It is started on first use, so that schedulers that never run the ILP never check out a license.
+_ENV = None
+
+
+def _gurobi_env() -> Env:
+    global _ENV
+    if _ENV is None:
+        _ENV = Env(empty=True)
+        _ENV.setParam("OutputFlag", 0)
+        _ENV.start()
+        atexit.register(_ENV.dispose)
+    return _ENV
+
 
 class Scheduler:
     """
@@ -13,16 +37,45 @@ class Scheduler:
     This formulates the problem, runs the simulation, and then adjusts the completion rate of the observations.
     """
 
-    def __init__(self, timeslots: int, timeslot_length: float = 300):
+    def __init__(self, timeslots: int, timeslot_length: float = 300, use_gurobi: bool = False,
+                 debug: bool = False, prm_path: Optional[str] = None, verbose: bool = False):
         """
         Initializes the simulation and sets the current time block to 0 and the observations to empty.
 
         :param timeslots: the number of time blocks of time block length
         :param timeslot_length: the length of each time block, in s
+        :param use_gurobi: solve each timeslot with the Gurobi ILP instead of directly, e.g. for validation
+        :param debug: name the variables and constraints of the ILP after the observations, for inspection
+        :param prm_path: a Gurobi parameter file for the ILP, used instead of the default presolve, method, and
+                         thread settings: if it does not exist, the ILP is tuned on its first solve and the best
+                         parameters found are saved to it
+        :param verbose: print the progress of the simulation
         """
         self.timeslots = timeslots
         self.timeslot_length = timeslot_length
-        self.observations = Observations()
+        self.use_gurobi = use_gurobi
+        self.debug = debug
+        self.prm_path = prm_path
+        self.verbose = verbose
+        self.observations = Observations(timeslots)
+
+        # The ILP model, built on the first tick and reused by all subsequent ticks, its variables indexed by
+        # (id, site), and the number of observations it was built for.
+        self._model = None
+        self._vars: Dict[Tuple[int, resources.Site], Var] = {}
+        self._model_num_obs = 0
+
+        # Whether the tuned parameters in prm_path still have to be applied to the model.
+        self._params_pending = False
+
+        # The variables of the model in order, along with the observation and the site bit of each.
+        self._var_list: List[Var] = []
+        self._var_ids = np.empty((0,), dtype=int)
+        self._var_sites = np.empty((0,), dtype=np.uint8)
+
+        # The values the variables took in the last solve, in the order of _var_list.
+        # They are used as a MIP start for the next tick, as consecutive ticks share most of their variables.
+        self._last_solution = np.empty((0,), dtype=float)
 
     def schedule(self) -> List[List[str]]:
         """
@@ -34,15 +87,11 @@ class Scheduler:
         while timeslot < self.timeslots:
             current_schedule = self.tick(timeslot)
             scheduling.append(current_schedule)
-            print("\n\n*** TIMESLOT %s ***" % timeslot)
-            print("*** Schedule for timeslot %d: %s" % (timeslot, current_schedule))
-            print("*** Remaining times:")
-            for id in range(self.observations.num_obs):
-                print("Obs %d, used_time=%d, obs_time=%d, done=%s" % (id,
-                                                                      int(self.observations.used_time[id]),
-                                                                      int(self.observations.obs_time[id]),
-                                                                      self.observations.is_done(id)))
-            print("*** ENDING TIMESLOT %s ***\n\n\n" % timeslot)
+            if self.verbose:
+                print("\n\n*** TIMESLOT %s ***" % timeslot)
+                print("*** Schedule for timeslot %d: %s" % (timeslot, current_schedule))
+                print("*** Used times: %s" % self.observations.used_time)
+                print("*** ENDING TIMESLOT %s ***\n\n\n" % timeslot)
             timeslot += 1
         return scheduling
 
@@ -60,101 +109,197 @@ class Scheduler:
     def from_schedule_id(scheduler_id: str) -> Tuple[int, resources.Site]:
         """
         Given a scheduler ID, extract the observation and the site.
+        The scheduler itself works with (id, site) pairs: this is the inverse of to_schedule_id for users of the
+        schedules returned by schedule().
         :param scheduler_id: the scheduler ID
         :return: A tuple comprising the ID and the Site resource
         """
         fields = scheduler_id.split('_')
-        return int(fields[1]), resources.Site[fields[2]]
+        return int(fields[1]), _SITE_BY_NAME[fields[2]]
 
-    def do_work(self, scheduler_id: str):
+    @staticmethod
+    def set_fixed_params(m: Model):
         """
-        Register work done on an observation.
-        :param scheduler_id: the schedule ID of the observation
+        Set the parameters of the ILP that must hold regardless of tuning: no solver output, and a time limit.
+        :param m: the model
         """
-        # We have used up one of the time slots.
-        self.observations.used_time[Scheduler.from_schedule_id(scheduler_id)[0]] += self.timeslot_length
+        m.setParam("OutputFlag", False)
+        m.setParam("TimeLimit", 1.0)
 
-    def tick(self, timeslot: int):
+    def build_model(self):
         """
-        Perform one "tick" of the simulation, i.e. elapse the specified time block.
-        We formulate and solve the ILP for the specified time, print the schedule, and then adjust the observations.
-        If the last tick has passed, print the final results, i.e. the completion of each observation.
-
-        :param timeslot: the active timeslot, from [0, timeslots).
+        Formulate the ILP over all the observations.
+        The model is built once and then reused by every tick, which only adjusts the variable bounds and the
+        objective coefficients to reflect the timeslot and the current priorities.
         """
+        m = Model(env=_gurobi_env())
+
+        # The model is tiny, so the fixed costs of presolve, logging, and thread start-up outweigh the solve itself.
+        # With a parameter file, the presolve, method, and thread settings are left for tuning to choose instead:
+        # the tuner keeps any parameter that has already been set fixed.
+        Scheduler.set_fixed_params(m)
+        if self.prm_path is None:
+            m.setParam("Presolve", 0)
+            m.setParam("Method", 0)
+            m.setParam("Threads", 1)
+        m.ModelSense = GRB.MAXIMIZE
+
+        # The observations that can be scheduled at GN and at GS respectively at some timeslot.
+        ever_valid = np.bitwise_or.reduce(self.observations.site_mask, axis=1)
+        gn_ids = np.flatnonzero(ever_valid & GN.value).tolist()
+        gs_ids = np.flatnonzero(ever_valid & GS.value).tolist()
+
+        # Create the decision variables for each site in one call, indexed by observation:
+        # they will have 1 if the observation is scheduled at the site, and 0 otherwise.
+        gn_vs = m.addVars(gn_ids, ub=1.0, vtype=GRB.BINARY,
+                          name=[Scheduler.to_schedule_id(id, GN) for id in gn_ids] if self.debug else "")
+        gs_vs = m.addVars(gs_ids, ub=1.0, vtype=GRB.BINARY,
+                          name=[Scheduler.to_schedule_id(id, GS) for id in gs_ids] if self.debug else "")
+        vs = {(id, GN): v for id, v in gn_vs.items()}
+        vs.update({(id, GS): v for id, v in gs_vs.items()})
+
+        # If an observation can be run at both resources, make sure that it is only run at one of the two resources.
+        both_ids = sorted(set(gn_ids) & set(gs_ids))
+        m.addConstrs((gn_vs[id] + gs_vs[id] <= 1 for id in both_ids), name="c_not_both" if self.debug else "")
+
+        # At most one observation runs at GN at a time. The constraint is shared by every timeslot: observations
+        # that cannot run at GN in a timeslot are excluded through the upper bounds of their variables.
+        m.addConstr(LinExpr([1.0] * len(gn_vs), gn_vs.values()) <= 1, "c_gn")
+
+        # At most one observation runs at GS at a time. The constraint is shared by every timeslot: observations
+        # that cannot run at GS in a timeslot are excluded through the upper bounds of their variables.
+        m.addConstr(LinExpr([1.0] * len(gs_vs), gs_vs.values()) <= 1, "c_gs")
 
-        print("*** BEGINNING TIMESLOT %s ***" % timeslot)
+        # The model is complete: call update on it to indicate that this is the case.
+        m.update()
 
-        self.observations.tick(timeslot)
+        self._model = m
+        self._vars = vs
+        self._var_list = list(vs.values())
+        self._var_ids = np.array([id for id, _ in vs], dtype=int)
+        self._var_sites = np.array([site.value for _, site in vs], dtype=np.uint8)
+        self._last_solution = np.zeros(len(vs))
+        self._params_pending = self.prm_path is not None
 
-        m = Model()
-        m.setParam("OutputFlag", False)
+    def load_params(self):
+        """
+        Apply the tuned parameters in prm_path to the model.
+        The first time, when the file does not exist yet, tune the model and save the best parameters found so that
+        the tuning is not repeated by later models.
+        """
+        m = self._model
+        if os.path.exists(self.prm_path):
+            m.read(self.prm_path)
+        else:
+            m.tune()
+            if m.TuneResultCount > 0:
+                m.getTuneResult(0)
+                m.write(self.prm_path)
+
+            # Loading a tuning result resets all the other parameters to their defaults.
+            Scheduler.set_fixed_params(m)
+        self._params_pending = False
+
+    def solve_ilp(self, site_mask: np.ndarray) -> List[Tuple[int, resources.Site]]:
+        """
+        Solve the scheduling problem for a timeslot with the Gurobi ILP.
 
-        # Create all the decision variables and the constraints.
-        vs = {}
-
-        # GN- and GS-specific variables:
-        gn_vs = set()
-        gs_vs = set()
-
-        # Create variables for incomplete observations.
-        for id in [id for id in range(self.observations.num_obs)
-                   if not self.observations.is_done(id)]:
-
-            # If this observation can be scheduled at GN at this timeslot, create a variable:
-            # It will have 1 if it is scheduled, and 0 otherwise.
-
-            # Keep track on the number of resources we can run observation id on at this timeslot to ensure
-            # it only runs on one resource.
-            resource_count = 0
-            if resources.Site.GN in self.observations.valid_site_times[id][timeslot]:
-                v = m.addVar(ub=1, vtype=GRB.BINARY, name=Scheduler.to_schedule_id(id, resources.Site.GN))
-                vs[(id, resources.Site.GN)] = v
-                m.update()
-                gn_vs.add(v)
-                resource_count += 1
-            if resources.Site.GS in self.observations.valid_site_times[id][timeslot]:
-                v = m.addVar(ub=1, vtype=GRB.BINARY, name=Scheduler.to_schedule_id(id, resources.Site.GS))
-                vs[(id, resources.Site.GS)] = v
-                m.update()
-                gs_vs.add(v)
-                resource_count += 1
-
-            # If this observation can be run at both resources, make sure that it is only run at one of the two
-            # resources.
-            if resource_count == 2:
-                m.addConstr(vs[(id, resources.Site.GN)] + vs[(id, resources.Site.GS)] <= 1, "c_not_both_%d" % id)
-
-        # Of all the observations that can start at GN at this timeslice, only one at a time is allowed.
-        m.addConstr(sum(gn_vs) <= 1, "c_gn")
-
-        # Of all the observations that can start at GN at this timeslice, only one at a time is allowed.
-        m.addConstr(sum(gs_vs) <= 1, "c_gn")
-
-        # Create the objective function on which we wish to maximize.
-        # print("**** %s ****" % self.observations.priority)
-        m.setObjective(sum([self.observations.priority[id] * vs[(id, res)] for (id, res) in vs.keys()]), GRB.MAXIMIZE)
+        :param site_mask: the bitmask of the sites at which each observation can be scheduled in the timeslot
+        :return: the (id, site) pairs scheduled in the timeslot
+        """
+        # Build the model on the first tick, or if observations have been added since it was built.
+        if self._model is None or self._model_num_obs != self.observations.num_obs:
+            self.build_model()
+            self._model_num_obs = self.observations.num_obs
+        m = self._model
+
+        # Only incomplete observations that can be scheduled at a site at this timeslot may be chosen there:
+        # the others have their variables fixed to 0. Set the attributes of all the variables in one call each.
+        ub = (site_mask[self._var_ids] & self._var_sites != 0).astype(float)
+        m.setAttr("UB", self._var_list, ub.tolist())
+        m.setAttr("Obj", self._var_list, self.observations.priority[self._var_ids].tolist())
+        m.setAttr("Start", self._var_list, (self._last_solution * ub).tolist())
 
-        # The model is complete: call update on it to indicate that this is the case.
+        # Run the ILP.
         m.update()
+        if self._params_pending:
+            self.load_params()
+        m.optimize()
 
-        # Auto-tune parameter settings.
-        m.tune()
+        # Now we determine the schedule for this tick, fetching the solution values in one call rather than one call
+        # per variable.
+        xs = m.getAttr("X", self._var_list)
+        self._last_solution = np.array(xs)
 
-        # Run the ILP.
-        m.optimize()
+        # Extract the (id, site) pairs of the variables that are set, if any:
+        scheduled = [key for key, x in zip(self._vars.keys(), xs) if x > 0.5]
+        return sorted(scheduled, key=lambda a: (a[0], a[1].value))
+
+    def solve_direct(self, site_mask: np.ndarray) -> List[Tuple[int, resources.Site]]:
+        """
+        Solve the scheduling problem for a timeslot directly, without a MIP solver.
+
+        At most one observation runs at each site, and an observation runs at no more than one site, so an optimal
+        schedule pairs one of the two highest priority observations that can run at GN with one of the two highest
+        priority observations that can run at GS (or leaves a site idle). It suffices to try these combinations.
+
+        :param site_mask: the bitmask of the sites at which each observation can be scheduled in the timeslot
+        :return: the (id, site) pairs scheduled in the timeslot
+        """
+        priority = self.observations.priority
+        gn_ids = np.flatnonzero(site_mask & GN.value)
+        gs_ids = np.flatnonzero(site_mask & GS.value)
+
+        # The two best candidates for each site, where None leaves the site idle.
+        gn_cands = sorted(gn_ids, key=lambda id: priority[id], reverse=True)[:2] + [None]
+        gs_cands = sorted(gs_ids, key=lambda id: priority[id], reverse=True)[:2] + [None]
+
+        best = []
+        best_priority = 0.0
+        for gn_id in gn_cands:
+            for gs_id in gs_cands:
+                if gn_id is not None and gn_id == gs_id:
+                    continue
+                assignment = [(id, site) for id, site in ((gn_id, GN), (gs_id, GS)) if id is not None]
+                total = sum(priority[id] for id, _ in assignment)
+                if total > best_priority:
+                    best = assignment
+                    best_priority = total
+
+        return sorted(best, key=lambda a: (a[0], a[1].value))
+
+    def tick(self, timeslot: int):
+        """
+        Perform one "tick" of the simulation, i.e. elapse the specified time block.
+        We solve the problem for the specified time and then adjust the observations. Progress is only printed if the
+        scheduler is verbose.
+
+        :param timeslot: the active timeslot, from [0, timeslots).
+        :return: the schedule IDs of the observations scheduled in the timeslot
+        """
+
+        if self.verbose:
+            print("*** BEGINNING TIMESLOT %s ***" % timeslot)
 
-        # Now we determine the schedule for this tick and adjust the observation completion times appropriately.
-        # print('\n\n*** ATTR ***')
-        # m.printAttr('X')
+        self.observations.tick(timeslot)
+
+        # The incomplete observations, and the sites at which each of them can be scheduled at this timeslot.
+        # Completed observations cannot be scheduled anywhere.
+        active_ids = np.flatnonzero(self.observations.used_time < self.observations.obs_time)
+        site_mask = np.zeros(self.observations.num_obs, dtype=np.uint8)
+        site_mask[active_ids] = self.observations.site_mask[active_ids, timeslot]
 
-        s_ids = m.getVars()
+        # With at most two incomplete observations, there are at most nine possible schedules, which the direct
+        # solver enumerates, so there is no point in running the ILP.
+        if self.use_gurobi and len(active_ids) > 2:
+            scheduled = self.solve_ilp(site_mask)
+        else:
+            scheduled = self.solve_direct(site_mask)
 
-        # Extract the variables that correspond to observations, if any:
-        current_scheduling = [s_id.VarName for s_id in s_ids if s_id.X == 1]
-        for c in current_scheduling:
-            self.do_work(c)
-        return current_scheduling
+        # We have used up one of the time slots for each scheduled observation.
+        for id, _ in scheduled:
+            self.observations.used_time[id] += self.timeslot_length
+        return [Scheduler.to_schedule_id(id, site) for id, site in scheduled]
 
 
 def run_simulation1():
@@ -243,11 +388,45 @@ def run_simulation2():
     return sched, sched.schedule()
 
 
+def validate_direct_solver(instances: int = 300, seed: int = 0):
+    """
+    Check that the direct solver finds schedules with the same total priority as the ILP on random single-timeslot
+    instances. The bands and times are drawn from small sets, so that many observations tie in priority, and band 4
+    observations have priority zero, so that the ILP may schedule them or not at no cost.
+
+    :param instances: the number of random instances to check
+    :param seed: the seed of the random number generator
+    """
+    rng = np.random.default_rng(seed)
+    for _ in range(instances):
+        sched = Scheduler(1, 300, use_gurobi=True)
+        for _ in range(rng.integers(1, 8)):
+            mask = int(rng.integers(0, 4))
+            sites = {site for site in Site if mask & site.value}
+            sched.observations.add_obs(str(rng.integers(1, 5)), {0: sites},
+                                       float(rng.choice([600, 1200])), float(rng.choice([300, 600])))
+        sched.observations.tick(0)
+
+        priority = sched.observations.priority
+        site_mask = sched.observations.site_mask[:, 0]
+        direct = sched.solve_direct(site_mask)
+        ilp = sched.solve_ilp(site_mask)
+        direct_priority = sum(priority[id] for id, _ in direct)
+        ilp_priority = sum(priority[id] for id, _ in ilp)
+        assert abs(direct_priority - ilp_priority) < 1e-6, \
+            "direct schedule %s (%f) differs from ILP schedule %s (%f)" % (direct, direct_priority, ilp, ilp_priority)
+
+
 """
 *** MAIN: DEFINE THE OBSERVATIONS AND KICK-OFF ***
 """
 if __name__ == '__main__':
 
+    # Validating the direct solver runs the ILP, so it is only done on request: python scheduler.py --validate
+    if '--validate' in sys.argv[1:]:
+        validate_direct_solver()
+        print("*** Direct solver agrees with the ILP ***")
+
     sched, final_sched = run_simulation2()
 
     print("*** SCHEDULE ***")
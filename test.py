@@ -16,7 +16,6 @@ mn = m.addConstr(0.3 * s <= 50, name="manganese")
 pc = m.addConstr(p >= 10)
 
 m.update()
-m.tune()
 m.optimize()
 
 print('\n\n*** MODEL ***')